@@ -2,16 +2,17 @@ import adsk.core
 import traceback
 from pathlib import Path
 from datetime import datetime
-from typing import NamedTuple, List, Set, Dict
+from typing import NamedTuple, List, Set, Dict, Tuple
 from enum import Enum, StrEnum
 from dataclasses import dataclass
 import hashlib
-import re
+import heapq
 from collections import defaultdict
 import itertools
 import json
+import re
 import os
-from functools import partial
+from functools import partial, lru_cache
 
 # If you have a bunch of files already existing and really want the files' date-modified attr
 # to be correct but don't want to rerun an export, you can change this to True for a single run, then
@@ -19,6 +20,7 @@ from functools import partial
 update_existing_file_times = False
 
 # Older versions of this script used '_' as seperator but Fusion 360 uses ' ' per default in manual exports.
+# This is the default, each run uses Ctx.version_separator
 VERSION_SEPARATOR = '_' # use either ' ' or '_'
 
 log_file = None
@@ -29,11 +31,22 @@ handlers = []
 # and also from `project` to (project id, None) if subfolders not enabled
 # this is kinda hacky but not sure how reliable keying on the list item itself is
 project_folders_d = {} # {f'{project.name}/{folder.name}': (project.id, folder.id)}
+# walking every project (and its folders) is slow, so toggling show_folders reuses what we walked before
+# cleared whenever the dialog is created so each run starts from fresh data
+projects_list_cache = {} # {show_folders: [(name, project.id, folder.id or None)]}
 
 last_settings_path = Path(__file__).parent / 'last_settings.json'
 
+# output folders we've already mkdir'd this run, see ensure_dir
+created_dirs = set()
+# {folder: names in folder}, each folder is listed once per run and we add to it as we export, see dir_listing
+dir_listings = {}
+
 def log(*args):
     print(*args, file=log_fh)
+
+def flush_log():
+    """the log is block buffered, we flush after each folder and before opening a document"""
     log_fh.flush()
 
 def init_directory(name):
@@ -41,10 +54,17 @@ def init_directory(name):
     directory.mkdir(exist_ok=True)
     return directory
 
+def ensure_dir(directory: str):
+    """mkdir (with parents) the first time we export into directory, afterwards it's just a set lookup"""
+    if directory in created_dirs:
+        return
+    os.makedirs(directory, exist_ok=True)
+    created_dirs.add(directory)
+
 def init_logging(directory):
     global log_file, log_fh
     log_file = directory / '{:%Y_%m_%d_%H_%M}.txt'.format(datetime.now())
-    log_fh = open(log_file, 'w', encoding="utf-8")
+    log_fh = open(log_file, 'w', buffering=2**16, encoding="utf-8")
 
 def load_last_settings():
     if not last_settings_path.exists():
@@ -54,7 +74,8 @@ def load_last_settings():
 
 def save_last_settings(d):
     with open(last_settings_path, 'w') as fh:
-        json.dump(d, fh, indent=2)
+        # compact since it's rewritten on every run and only read back by us, the log has the readable copy
+        json.dump(d, fh, separators=(',', ':'))
 
 class Format(Enum):
     F3D = 'f3d'
@@ -69,26 +90,42 @@ FormatFromName = {x.value: x for x in Format}
 
 DEFAULT_SELECTED_FORMATS = {Format.F3D.value, Format.STEP.value}
 
+# I'm just taking these from here https://github.com/tapnair/apper/blob/master/apper/Fusion360Utilities.py
+# is there a nicer way to do this??
+# {format: (exportManager, design, output path str) -> export options}
+EXPORT_OPTIONS_FACTORIES = {
+    Format.F3D: lambda em, design, path: em.createFusionArchiveExportOptions(path),
+    Format.STL: lambda em, design, path: em.createSTLExportOptions(design.rootComponent, path),
+    Format.TMF: lambda em, design, path: em.createC3MFExportOptions(design.rootComponent, path),
+    Format.STEP: lambda em, design, path: em.createSTEPExportOptions(path),
+    Format.IGES: lambda em, design, path: em.createIGESExportOptions(path),
+    Format.SAT: lambda em, design, path: em.createSATExportOptions(path),
+    Format.SMT: lambda em, design, path: em.createSMTExportOptions(path),
+}
+
+# document types we know how to open and export, everything else is skipped before opening
+HANDLED_EXTENSIONS = frozenset({'f3d'})
+
 archive_extensions = ['.zip', '.rar', '.gz', '.tar.gz', '.tar.bz2', '.tar.xz']
 
 class Ctx(NamedTuple):
     app: adsk.core.Application
-    folder: Path
+    folder: Path # the export directory, subfolders are passed around separately as str
     formats: List[Format]
-    projects_folders: Dict[str, List[str]] # {projectId: [folderId+]} empty list is taken to mean "no filter"
+    projects_folders: Dict[str, Set[str] | None] # {projectId: {folderId+}} None is taken to mean "no filter"
     unhide_all: bool
     save_sketches: bool
     num_versions: int # -1 means all versions
+    version_separator: str = VERSION_SEPARATOR
 
-    def extend(self, other):
-        return self._replace(folder=self.folder / other)
+    # Ctx only holds settings for the whole run, the output folder we're currently in is passed around next to it
 
     def to_dict(self):
         d = self._asdict()
         d.pop('app')
         d['folder'] = str(d['folder'])
         d['formats'] = [x.value for x in d['formats']]
-        d['projects_folders'] = {k: list(v) for k, v in d['projects_folders'].items()}
+        d['projects_folders'] = {k: None if v is None else list(v) for k, v in d['projects_folders'].items()}
         return d
 
     def dumps(self):
@@ -99,27 +136,49 @@ class Ctx(NamedTuple):
         d['app'] = app
         d['folder'] = Path(d['folder'])
         d['formats'] = [FormatFromName[x] for x in d['formats']]
-        d['projects_folders'] = {k: set(v) for k, v in d['projects_folders'].items()}
+        # older settings used an empty list for "no filter"
+        d['projects_folders'] = {k: set(v) if v else None for k, v in d['projects_folders'].items()}
         return cls(**d)
 
     def has_show_folders(self):
-        return any(len(v) > 0 for v in self.projects_folders.values())
+        return any(v is not None for v in self.projects_folders.values())
+
+class FileMeta(NamedTuple):
+    """The DataFile attributes used per format/sketch, read once since every access goes through swig"""
+    name: str
+    version: int
+    mtime: int # dateModified
+    export_prefix: str # `{sanitized name}{version separator}v{version}.`, only the extension differs per format
+
+    @classmethod
+    def from_file(cls, ctx: Ctx, file: adsk.core.DataFile):
+        name = file.name
+        version = file.versionNumber
+        export_prefix = f'{sanitize_filename(name)}{ctx.version_separator}v{version}.'
+        return cls(name, version, file.dateModified, export_prefix)
 
 class LazyDocument:
     def __init__(self, ctx: Ctx, file: adsk.core.DataFile):
         self._ctx = ctx
         self._document = None
+        self._design = None
+        self._root_component = None
         self.file = file
 
     def open(self):
         if self._document is not None:
             return
         log(f'Opening `{self.file.name}`')
+        # opening is what brings Fusion down if anything does, and then nothing after this gets to flush
+        flush_log()
         self._document = self._ctx.app.documents.open(self.file)
         self._document.activate()
+        # every format and the sketches need these, so only go through swig for them once
+        self._design = design_from_document(self._document)
+        self._root_component = self._design.rootComponent
 
         if self._ctx.unhide_all:
-            unhide_all_in_document(self._document)
+            unhide_all_in_component(self._root_component)
 
     def close(self):
         if self._document is None:
@@ -129,11 +188,11 @@ class LazyDocument:
 
     @property
     def design(self):
-        return design_from_document(self._document)
+        return self._design
 
     @property
     def rootComponent(self):
-        return self.design.rootComponent
+        return self._root_component
 
     def __enter__(self):
         return self
@@ -141,82 +200,138 @@ class LazyDocument:
     def __exit__(self, *args):
         self.close()
 
-@dataclass
+# Single exports (and skipped files) return one of the constant (saved, skipped, errored) tuples below.
+# Each traversal function that sums results makes one Counter and adds those into it
+Counts = Tuple[int, int, int]
+
+@dataclass(slots=True)
 class Counter:
     saved: int = 0
     skipped: int = 0
     errored: int = 0
 
-    def __add__(self, other):
-        return Counter(
-            self.saved + other.saved,
-            self.skipped + other.skipped,
-            self.errored + other.errored,
-        )
-    def __iadd__(self, other):
-        self.saved += other.saved
-        self.skipped += other.skipped
-        self.errored += other.errored
+    def __iadd__(self, counts):
+        """counts is a Counts tuple or another Counter"""
+        saved, skipped, errored = counts
+        self.saved += saved
+        self.skipped += skipped
+        self.errored += errored
         return self
 
+    def __iter__(self):
+        return iter((self.saved, self.skipped, self.errored))
+
+SAVED = (1, 0, 0)
+SKIPPED = (0, 1, 0)
+
 def design_from_document(document: adsk.core.Document):
     return adsk.fusion.FusionDocument.cast(document).design
 
-def unhide_all_in_document(document: adsk.core.Document):
-    unhide_all_in_component(design_from_document(document).rootComponent)
-
 def unhide_all_in_component(component):
-    component.isBodiesFolderLightBulbOn = True
-    component.isSketchFolderLightBulbOn = True
-
-    for brep in component.bRepBodies:
-        brep.isLightBulbOn = True
-
-    for body in component.meshBodies:
-        body.isLightBulbOn = True
-
-    # I find the name occurrences very confusing, but apparently that is what a sub-component is called
-    for occurrence in component.occurrences:
-        occurrence.isLightBulbOn = True
-        unhide_all_in_component(occurrence.component)
-
+    # explicit stack like visit_sketches, and since many occurrences can share the same component
+    # (eg a bunch of the same screw) we only unhide the insides of each component once
+    seen = set()
+    stack = [component]
+    while stack:
+        component = stack.pop()
+        if component.id in seen:
+            continue
+        seen.add(component.id)
+
+        component.isBodiesFolderLightBulbOn = True
+        component.isSketchFolderLightBulbOn = True
+
+        for brep in component.bRepBodies:
+            brep.isLightBulbOn = True
+
+        for body in component.meshBodies:
+            body.isLightBulbOn = True
+
+        # I find the name occurrences very confusing, but apparently that is what a sub-component is called
+        for occurrence in component.occurrences:
+            occurrence.isLightBulbOn = True
+            stack.append(occurrence.component)
+
+# this list of characters is just from trying to rename a file in Explorer (on Windows)
+# I think the actual requirements are per fileystem and will be different on Mac
+# I'm not sure how other unicode chars are handled
+# (a compiled pattern measured faster than str.translate with a table for this)
+BAD_FILENAME_CHARS_RE = re.compile(r'[:\\/*?<>|"]')
+
+# the same folder/file/component names come through here for every version and format, so cache them
+# (this also means we only log about a given bad name once)
+@lru_cache(maxsize=None)
 def sanitize_filename(name: str) -> str:
     """
     Remove "bad" characters from a filename. Right now just punctuation that Windows doesn't like
     If any chars are removed, we append _{hash} so that we don't accidentally clobber other files
     since eg `Model 1/2` and `Model 1 2` would otherwise have the same name
     """
-    # this list of characters is just from trying to rename a file in Explorer (on Windows)
-    # I think the actual requirements are per fileystem and will be different on Mac
-    # I'm not sure how other unicode chars are handled
-    with_replacement = re.sub(r'[:\\/*?<>|"]', ' ', name)
-    if name == with_replacement:
+    if BAD_FILENAME_CHARS_RE.search(name) is None:  # the common case, no need to build a replacement
         return name
+    with_replacement = BAD_FILENAME_CHARS_RE.sub(' ', name)
     log(f'filename `{name}` contained bad chars, replacing by `{with_replacement}`')
+    # this hash ends up in exported filenames (and the Readme), so switching to a cheaper hash would make
+    # every existing export with a bad name look missing and get exported again. With the cache above
+    # it only runs once per unique bad name anyway
     hash = hashlib.sha256(name.encode()).hexdigest()[:8]
     return f'{with_replacement}_{hash}'
 
-def set_mtime(path: Path, time: int):
+def set_mtime(path: str, time: int):
     """utime wants to set atime and mtime, we just set it the same"""
     os.utime(path, (time, time))
 
-def output_path_exists(path: Path, doc: LazyDocument) -> bool:
+class DirListing(NamedTuple):
+    """The names in folder, plus their lower() so a name that only differs in case can be found"""
+    folder: str
+    names: Set[str]
+    lowered: Set[str]
+
+    def __contains__(self, name):
+        if name in self.names:
+            return True
+        # whether `A v1.f3d` counts as `a v1.f3d` depends on the volume (NTFS and APFS by default say yes,
+        # case-sensitive ones no), so a case-only match is left to the filesystem like Path.exists() did
+        return name.lower() in self.lowered and os.path.exists(os.path.join(self.folder, name))
+
+    def add(self, name):
+        self.names.add(name)
+        self.lowered.add(name.lower())
+
+def dir_listing(folder: str) -> DirListing:
+    """
+    Names of everything in folder. One scandir per folder instead of a stat for every file (and archive
+    extension) we check. Exports add their name to this listing so it stays correct for the rest of the run
+    """
+    listing = dir_listings.get(folder)
+    if listing is None:
+        try:
+            with os.scandir(folder) as it:
+                names = {entry.name for entry in it}
+        except FileNotFoundError:
+            names = set()
+        listing = DirListing(folder, names, {name.lower() for name in names})
+        dir_listings[folder] = listing
+    return listing
+
+def output_path_exists(folder: str, name: str, mtime: int) -> bool:
     """
     Check if the file path already exists with version extension.
     Also checks for archived versions of the files to export and if update_existing_file_times
     is set, updates the mtime of existing files (not the archives).
     """
-    if path.exists():
+    path = os.path.join(folder, name)
+    existing = dir_listing(folder)
+    if name in existing or (update_existing_file_times and os.path.exists(path)):
         if update_existing_file_times:
-            set_mtime(path, doc.file.dateModified)
+            set_mtime(path, mtime)
             log(f'{path} already exists, but mtime was corrected')
         else:
             log(f'{path} already exists, skipping')
         return True
 
     for archive_extension in archive_extensions:
-        archive_path = path.with_name(path.name + archive_extension)
-        if archive_path.exists():
+        if name + archive_extension in existing:
             log(f'{path} already exists as archive, skipping')
             return True
 
@@ -224,92 +339,89 @@ def output_path_exists(path: Path, doc: LazyDocument) -> bool:
 
 # component: adsk.core.Component but that doesn't exist for some reason?
 # sketch   : adsk.core.Sketch likewise
-def export_sketch(ctx: Ctx, doc: LazyDocument, component, sketch):
-    output_path = ctx.folder / f'{sanitize_filename(sketch.name)}.dxf'
-    if output_path_exists(output_path, doc):
-        return Counter(skipped=1)
+def export_sketch(ctx: Ctx, folder: str, meta: FileMeta, component, sketch) -> Counts:
+    name = f'{sanitize_filename(sketch.name)}.dxf'
+    if output_path_exists(folder, name, meta.mtime):
+        return SKIPPED
 
+    output_path = os.path.join(folder, name)
     log(f'Exporting sketch {sketch.name} in {component.name} to {output_path}')
-    output_path.parent.mkdir(exist_ok=True, parents=True)
-    sketch.saveAsDXF(str(output_path))
-    set_mtime(output_path, doc.file.dateModified)
-    return Counter(saved=1)
+    ensure_dir(folder)
+    sketch.saveAsDXF(output_path)
+    dir_listing(folder).add(name)
+    set_mtime(output_path, meta.mtime)
+    return SAVED
 
-def visit_sketches(ctx: Ctx, doc: LazyDocument, component):
+def visit_sketches(ctx: Ctx, folder: str, meta: FileMeta, component) -> Counter:
     counter = Counter()
-    for sketch in component.sketches:
-        try:
-            counter += export_sketch(ctx, doc, component, sketch)
-        except Exception:
-            log(traceback.format_exc())
-            counter.errored += 1
+    # explicit stack instead of recursion so deep assemblies can't hit the recursion limit
+    stack = [(folder, component)]
+    while stack:
+        folder, component = stack.pop()
 
-    for occurrence in component.occurrences:
-        counter += visit_sketches(ctx.extend(sanitize_filename(occurrence.name)), doc, occurrence.component)
+        for sketch in component.sketches:
+            try:
+                counter += export_sketch(ctx, folder, meta, component, sketch)
+            except Exception:
+                log(traceback.format_exc())
+                counter.errored += 1
+
+        # pushed in reverse so they are popped (and exported) in the same order as the Fusion UI
+        stack.extend((os.path.join(folder, sanitize_filename(occurrence.name)), occurrence.component)
+                     for occurrence in reversed(list(component.occurrences)))
 
     return counter
 
-def export_filename(ctx: Ctx, format: Format, file: adsk.core.DataFile):
-    sanitized = sanitize_filename(file.name)
-    name = f'{sanitized}{VERSION_SEPARATOR}v{file.versionNumber}.{format.value}'
-    return ctx.folder / name
+def export_filename(format: Format, meta: FileMeta) -> str:
+    return meta.export_prefix + format.value
 
-def export_file(ctx: Ctx, format: Format, doc: LazyDocument) -> Counter:
-    output_path = export_filename(ctx, format, doc.file)
-    if output_path_exists(output_path, doc):
-        return Counter(skipped=1)
+# paths are kept as plain str in here, they only go to os.* and the Fusion API which wants str anyway
+def export_file(ctx: Ctx, folder: str, format: Format, doc: LazyDocument, meta: FileMeta) -> Counts:
+    name = export_filename(format, meta)
+    if output_path_exists(folder, name, meta.mtime):
+        return SKIPPED
+
+    factory = EXPORT_OPTIONS_FACTORIES.get(format)
+    if factory is None:
+        raise Exception(f'Got unknown export format {format}')
 
     doc.open()
 
-    # I'm just taking this from here https://github.com/tapnair/apper/blob/master/apper/Fusion360Utilities.py
-    # is there a nicer way to do this??
     design = doc.design
     em = design.exportManager
 
-    output_path.parent.mkdir(exist_ok=True, parents=True)
-    output_path_s = str(output_path)
-
-    if format == Format.F3D:
-        options = em.createFusionArchiveExportOptions(output_path_s)
-    elif format == Format.STL:
-        options = em.createSTLExportOptions(design.rootComponent, output_path_s)
-    elif format == Format.TMF:
-        options = em.createC3MFExportOptions(design.rootComponent, output_path_s)
-    elif format == Format.STEP:
-        options = em.createSTEPExportOptions(output_path_s)
-    elif format == Format.IGES:
-        options = em.createIGESExportOptions(output_path_s)
-    elif format == Format.SAT:
-        options = em.createSATExportOptions(output_path_s)
-    elif format == Format.SMT:
-        options = em.createSMTExportOptions(output_path_s)
+    ensure_dir(folder)
 
-    else:
-        raise Exception(f'Got unknown export format {format}')
-
-    em.execute(options)
-    set_mtime(output_path, doc.file.dateModified)
+    output_path = os.path.join(folder, name)
+    em.execute(factory(em, design, output_path))
+    dir_listing(folder).add(name)
+    set_mtime(output_path, meta.mtime)
     log(f'Saved {output_path}')
 
-    return Counter(saved=1)
+    return SAVED
 
-def visit_file(ctx: Ctx, file: adsk.core.DataFile) -> Counter:
-    log(f'Visiting file {file.name} v{file.versionNumber}.{file.fileExtension}')
+def visit_file(ctx: Ctx, folder: str, file: adsk.core.DataFile) -> Counter | Counts:
+    # check the extension first so skipped files don't pay for the rest of FileMeta (or get sanitized)
+    extension = file.fileExtension
+    if extension not in HANDLED_EXTENSIONS:
+        name = file.name
+        log(f'Visiting file {name} v{file.versionNumber}.{extension}')
+        log(f'file {name} has extension {extension} which is not currently handled, skipping')
+        return SKIPPED
 
-    if file.fileExtension != 'f3d':
-        log(f'file {file.name} has extension {file.fileExtension} which is not currently handled, skipping')
-        return Counter(skipped=1)
+    meta = FileMeta.from_file(ctx, file)
+    log(f'Visiting file {meta.name} v{meta.version}.{extension}')
 
     with LazyDocument(ctx, file) as doc:
         counter = Counter()
 
         if ctx.save_sketches:
             doc.open()
-            counter += visit_sketches(ctx.extend(sanitize_filename(doc.rootComponent.name)), doc, doc.rootComponent)
+            counter += visit_sketches(ctx, os.path.join(folder, sanitize_filename(doc.rootComponent.name)), meta, doc.rootComponent)
 
         for format in ctx.formats:
             try:
-                counter += export_file(ctx, format, doc)
+                counter += export_file(ctx, folder, format, doc, meta)
             except Exception:
                 counter.errored += 1
                 log(traceback.format_exc())
@@ -317,6 +429,12 @@ def visit_file(ctx: Ctx, file: adsk.core.DataFile) -> Counter:
         return counter
 
 def file_versions(file: adsk.core.DataFile, num_versions):
+    # the default is only the current version, in which case we don't need to fetch the (possibly long)
+    # list of versions from the server at all
+    if num_versions == 0:
+        yield file
+        return
+
     # file.versions (should) start with the current/latest version
     # we discovered that file.versions is actually sorted by the string of the versionNumber
     # so for something with 11 versions, we get [9, 8, 7, 6, 5, 4, 3, 2, 11, 10, 1]
@@ -325,15 +443,16 @@ def file_versions(file: adsk.core.DataFile, num_versions):
     # it's possible this is not ideal for very large version counts if the swig layer is actually lazy
     # and so we force the iterator, but not sure, and idk how to avoid it and still get the versions in the 
     # right order.
-    versions = sorted(file.versions, key=lambda x: x.versionNumber, reverse=True)
+    # Because of that we can't stop reading early, but when we only want a few we at least don't sort them all
+    if num_versions == -1:
+        versions = sorted(file.versions, key=lambda x: x.versionNumber, reverse=True)
+    else:
+        versions = heapq.nlargest(num_versions + 1, file.versions, key=lambda x: x.versionNumber)
 
     if versions[0].versionNumber != file.versionNumber:
         raise Exception(f'Expected versions[0] to be current file version, but got {versions[0].versionNumber}')
-    
-    if num_versions == -1:
-        versions = versions[1:]
-    else:
-        versions = versions[1:num_versions+1]
+
+    versions = versions[1:]
 
     yield file
     prev = file.versionNumber
@@ -343,52 +462,92 @@ def file_versions(file: adsk.core.DataFile, num_versions):
         yield v
         prev = v.versionNumber
 
-def visit_folder(ctx: Ctx, folder, recurse=True) -> Counter:
-    log(f'Visiting folder {folder.name}')
-
-    new_ctx = ctx.extend(sanitize_filename(folder.name))
+def visit_data_file(ctx: Ctx, folder: str, file: adsk.core.DataFile) -> Counter:
+    counter = Counter()
+    try:
+        for file_version in file_versions(file, ctx.num_versions):
+            counter += visit_file(ctx, folder, file_version)
+    except Exception:
+        log(f'Got exception visiting file\n{traceback.format_exc()}')
+        counter.errored += 1
+    return counter
 
+def visit_folder(ctx: Ctx, parent_path: str, folder, recurse=True) -> Counter:
     counter = Counter()
+    # (parent path, folder, recurse); explicit stack instead of recursion like visit_sketches
+    stack = [(parent_path, folder, recurse)]
+    while stack:
+        parent_path, folder, recurse = stack.pop()
+        log(f'Visiting folder {folder.name}')
 
-    for file in folder.dataFiles:
-        try:
-            for file_version in file_versions(file, ctx.num_versions):
-                counter += visit_file(new_ctx, file_version)
-        except Exception:
-            log(f'Got exception visiting file\n{traceback.format_exc()}')
-            counter.errored += 1
+        folder_path = os.path.join(parent_path, sanitize_filename(folder.name))
 
-    if recurse:
-        for sub_folder in folder.dataFolders:
-            counter += visit_folder(new_ctx, sub_folder)
+        for file in folder.dataFiles:
+            counter += visit_data_file(ctx, folder_path, file)
 
-    return counter
+        if recurse:
+            # reversed like the occurrences in visit_sketches so subfolders are visited in order
+            stack.extend((folder_path, sub_folder, True) for sub_folder in reversed(list(folder.dataFolders)))
 
-def main(ctx: Ctx) -> Counter:
-    init_directory(ctx.folder)
-    init_logging(ctx.folder)
+        flush_log()
 
-    log(ctx.dumps())
+    return counter
 
+def visit_project(ctx: Ctx, project_id: str, project, folder_ids) -> Counter:
     counter = Counter()
+    try:
+        if project is None:
+            raise Exception(f'Could not find project {project_id}')
 
-    for project_id, folder_ids in ctx.projects_folders.items():
-        project = ctx.app.data.dataProjects.itemById(project_id)
+        export_dir = str(ctx.folder)
+        root = project.rootFolder  # each access makes a new swig wrapper, so grab it once
 
-        if folder_ids == []:  # empty filter visit everything
-            counter += visit_folder(ctx, project.rootFolder)
+        if folder_ids is None:  # no filter visit everything
+            counter += visit_folder(ctx, export_dir, root)
 
         # if the root folder is the only thing selected, we take that to mean no recurse
-        elif folder_ids == [project.rootFolder.id]:
-            counter += visit_folder(ctx, project.rootFolder, recurse=False)
+        elif folder_ids == {root.id}:
+            counter += visit_folder(ctx, export_dir, root, recurse=False)
 
         else:
-            folders = project.rootFolder.dataFolders
+            folders = root.dataFolders
             # hmm this doesn't work, the itemsById doesn't return the folder
             # for folder_id in folder_ids:
             #     counter += visit_folder(ctx, folders.itemById(folder_id))
-            for folder in filter(lambda x: x.id in folder_ids, folders):
-                counter += visit_folder(ctx, folder)
+            remaining = set(folder_ids)  # copy, we discard from it
+            for folder in folders:
+                folder_id = folder.id
+                if folder_id not in remaining:
+                    continue
+                counter += visit_folder(ctx, export_dir, folder)
+                remaining.discard(folder_id)
+                if not remaining:  # don't walk the rest of the collection once everything is found
+                    break
+
+    # one broken project shouldn't stop the others from being exported
+    except Exception:
+        log(f'Got exception visiting project {project_id}\n{traceback.format_exc()}')
+        counter.errored += 1
+
+    return counter
+
+def main(ctx: Ctx) -> Counter:
+    created_dirs.clear()
+    dir_listings.clear()
+    # the module stays loaded between runs (eg through saved settings), and each run's log should
+    # still say which names had bad chars
+    sanitize_filename.cache_clear()
+    init_directory(ctx.folder)
+    init_logging(ctx.folder)
+
+    log(ctx.dumps())
+
+    counter = Counter()
+
+    # itemById is a search of the collection each time, so index all the projects in one pass
+    projects_by_id = {project.id: project for project in ctx.app.data.dataProjects}
+    for project_id, folder_ids in ctx.projects_folders.items():
+        counter += visit_project(ctx, project_id, projects_by_id.get(project_id), folder_ids)
 
     return counter
 
@@ -407,23 +566,33 @@ class I(StrEnum):
     save_sketches = 'save_sketches'
     version_separator_is_space = 'version_separator_is_space'
 
-def populate_data_projects_list(dropdown, show_folders=False, selected=None):
+def data_projects_list(show_folders):
+    if show_folders in projects_list_cache:
+        return projects_list_cache[show_folders]
+
     app = adsk.core.Application.get()
+    items = []
+    if show_folders:
+        for project in app.data.dataProjects:
+            project_name, project_id, root = project.name, project.id, project.rootFolder
+            for folder in itertools.chain([root], root.dataFolders):
+                items.append((f'{project_name}/{folder.name}', project_id, folder.id))
+    else:
+        for project in app.data.dataProjects:
+            items.append((project.name, project.id, None))
+
+    projects_list_cache[show_folders] = items
+    return items
+
+def populate_data_projects_list(dropdown, show_folders=False, selected=None):
     dropdown.listItems.clear()
 
     if selected is None:
         selected = []
 
-    if show_folders:
-        for project in app.data.dataProjects:
-            for folder in itertools.chain([project.rootFolder], project.rootFolder.dataFolders):
-                name = f'{project.name}/{folder.name}'
-                project_folders_d[name] = (project.id, folder.id)
-                dropdown.listItems.add(name, name in selected)
-    else:
-        for project in app.data.dataProjects:
-            project_folders_d[project.name] = (project.id, None)
-            dropdown.listItems.add(project.name, project.name in selected)
+    for name, project_id, folder_id in data_projects_list(show_folders):
+        project_folders_d[name] = (project_id, folder_id)
+        dropdown.listItems.add(name, name in selected)
 
 class ExporterCommandInputChangedHandler(adsk.core.InputChangedEventHandler):
     def notify(self, args):
@@ -455,6 +624,7 @@ class ExporterCommandCreatedEventHandler(adsk.core.CommandCreatedEventHandler):
 
             inputs = cmd.commandInputs
             last_settings = load_last_settings()
+            projects_list_cache.clear()
 
             export_folder = last_settings.get(I.directory, str(Path.home() / 'Desktop/Fusion360Export'))
             inputs.addStringValueInput(I.directory, 'Directory', export_folder)
@@ -499,18 +669,21 @@ class ExporterCommandDestroyHandler(adsk.core.CommandEventHandler):
             message_box_traceback()
 
 # Dont use yield and don't copy list items, swig wants to delete things
-def selected(inputs):
-    return [it.name for it in inputs if it.isSelected]
+def snapshot(list_items):
+    """[(name, isSelected)] read once so every later use doesn't go back through swig"""
+    return [(it.name, it.isSelected) for it in list_items]
+
+def selected(snap):
+    return [name for name, is_selected in snap if is_selected]
 
-def make_projects_folders(inputs):
+def make_projects_folders(selected_projects):
     ret = defaultdict(set)
-    for it in inputs.itemById(I.projects).listItems:
-        if it.isSelected:
-            project_id, folder_id = project_folders_d[it.name]
-            if folder_id is None:  # whole project was selected
-                ret[project_id] = []
-            else:
-                ret[project_id].add(folder_id)
+    for name in selected_projects:
+        project_id, folder_id = project_folders_d[name]
+        if folder_id is None:  # whole project was selected
+            ret[project_id] = None
+        else:
+            ret[project_id].add(folder_id)
     return ret
 
 def run_main(ctx):
@@ -530,6 +703,7 @@ def run_main(ctx):
         adsk.core.Application.get().userInterface.messageBox(f'Log file is at {log_file}\n{tb}')
         if log_fh is not None:
             log(f'Got top level exception\n{tb}')
+            flush_log()
     finally:
         if log_fh is not None:
             log_fh.close()
@@ -538,7 +712,7 @@ def input_value(inputs, name):
     return inputs.itemById(name).value
 
 def input_selected(inputs, name):
-    return selected(inputs.itemById(name).listItems)
+    return selected(snapshot(inputs.itemById(name).listItems))
 
 class ExporterCommandExecuteHandler(adsk.core.CommandEventHandler):
     def notify(self, args):
@@ -546,12 +720,14 @@ class ExporterCommandExecuteHandler(adsk.core.CommandEventHandler):
             inputs = args.command.commandInputs
             iv = partial(input_value, inputs)
             isel = partial(input_selected, inputs)
+            file_types = isel(I.file_types)
+            projects = isel(I.projects)
 
             save_last_settings({
                 I.directory: iv(I.directory),
-                I.file_types: isel(I.file_types),
+                I.file_types: file_types,
                 I.show_folders: iv(I.show_folders),
-                I.projects: isel(I.projects),
+                I.projects: projects,
                 I.unhide_all: iv(I.unhide_all),
                 I.save_sketches: iv(I.save_sketches),
                 I.version_count: iv(I.version_count),
@@ -559,19 +735,15 @@ class ExporterCommandExecuteHandler(adsk.core.CommandEventHandler):
                 I.version_separator_is_space: iv(I.version_separator_is_space),
             })
 
-            # kinda hacky
-            if iv(I.version_separator_is_space):
-                global VERSION_SEPARATOR
-                VERSION_SEPARATOR = ' '
-
             ctx = Ctx(
                 app = adsk.core.Application.get(),
                 folder = Path(iv(I.directory)),
-                formats = [FormatFromName[x] for x in isel(I.file_types)],
-                projects_folders = make_projects_folders(inputs),
+                formats = [FormatFromName[x] for x in file_types],
+                projects_folders = make_projects_folders(projects),
                 unhide_all = iv(I.unhide_all),
                 save_sketches = iv(I.save_sketches),
                 num_versions = -1 if iv(I.all_versions) else iv(I.version_count),
+                version_separator = ' ' if iv(I.version_separator_is_space) else VERSION_SEPARATOR,
             )
             run_main(ctx)
         except: